@@ -13,6 +13,7 @@
 # limitations under the License.
 import os
 import time
+import uuid
 from typing import Generator
 from tqdm import tqdm
 from hyperpyyaml import load_hyperpyyaml
@@ -103,6 +104,18 @@ class CosyVoice:
                 yield model_output
                 start_time = time.time()
 
+    def inference_zero_shot_batch(self, tts_texts, prompt_text, prompt_speech_16k, stream=False, speed=1.0, text_frontend=True):
+        # prompt feature is shared by all tts_texts, only extract it once and reuse it through a temporary zero_shot_spk_id
+        prompt_text = self.frontend.text_normalize(prompt_text, split=False, text_frontend=text_frontend)
+        zero_shot_spk_id = 'batch_{}'.format(uuid.uuid1())
+        self.add_zero_shot_spk(prompt_text, prompt_speech_16k, zero_shot_spk_id)
+        try:
+            for tts_text in tts_texts:
+                yield self.inference_zero_shot(tts_text, prompt_text, prompt_speech_16k, zero_shot_spk_id=zero_shot_spk_id,
+                                               stream=stream, speed=speed, text_frontend=text_frontend)
+        finally:
+            del self.frontend.spk2info[zero_shot_spk_id]
+
     def inference_cross_lingual(self, tts_text, prompt_speech_16k, zero_shot_spk_id='', stream=False, speed=1.0, text_frontend=True):
         for i in tqdm(self.frontend.text_normalize(tts_text, split=True, text_frontend=text_frontend)):
             model_input = self.frontend.frontend_cross_lingual(i, prompt_speech_16k, self.sample_rate, zero_shot_spk_id)
@@ -9,12 +9,18 @@ Usage:
 """
 
 import argparse
+import functools
+import mmap
 import os
 import re
+import stat
 import sys
+from concurrent.futures import ThreadPoolExecutor
+from itertools import groupby
 
+import soundfile as sf
 import torch
-import torchaudio
+import torch.multiprocessing as mp
 
 # Add third_party path
 sys.path.append('third_party/Matcha-TTS')
@@ -23,72 +29,145 @@ from cosyvoice.cli.cosyvoice import CosyVoice2
 from cosyvoice.utils.file_utils import load_wav
 from cosyvoice.utils.common import set_all_random_seed
 
+# A line break as universal newlines sees it: CRLF, LF or a lone CR
+_NL = rb'(?:\r\n|\r(?!\n)|\n)'
+# One SRT entry: an ID line, a non-blank timestamp line, then text from a non-blank line up to the next blank line
+_SRT_RE = re.compile(rb'(?<![^\r\n])[ \t]*(\d+)[ \t]*' + _NL + rb'([ \t]*\S[^\r\n]*)' + _NL
+                     + rb'([ \t]*\S.*?)(?=' + _NL + rb'[ \t]*' + _NL + rb'|\Z)', re.S)
+# Text skipped between two entries that ends in a blank line, i.e. a separate block
+_SRT_BLOCK_END_RE = re.compile(_NL + rb'[ \t]*' + _NL + rb'[ \t]*\Z')
+
+
+def _load_wav_cached(path, sr):
+    """
+    Load audio resampled to sr, caching the result next to the source file
+    The cache is a {path}.{sr}.pt tensor reused while it is newer than the audio
+    """
+    cache = f"{path}.{sr}.pt"
+    if os.path.exists(cache) and os.path.getmtime(cache) >= os.path.getmtime(path):
+        return torch.load(cache, map_location='cpu', mmap=True, weights_only=True)
+
+    speech = load_wav(path, sr)
+    try:
+        # Write then rename so concurrent batch workers never read a partial cache file
+        tmp_cache = f"{cache}.{os.getpid()}.tmp"
+        torch.save(speech, tmp_cache)
+        os.replace(tmp_cache, cache)
+    except OSError as e:
+        # Read-only reference directories still work, just without the cache
+        print(f"  警告: 无法写入缓存 {cache}: {str(e)}")
+    return speech
+
+
+@functools.lru_cache(maxsize=64)
+def _load_prompt_cached(path):
+    """Load reference audio at 16kHz, decoding each path only once"""
+    return _load_wav_cached(path, 16000)
+
 
 def parse_srt(srt_file):
     """
     Parse SRT file and extract subtitle entries
-    Returns list of dicts with 'id', 'start', 'end', 'text'
+    Returns list of dicts with 'id', 'timestamp', 'text'
     """
     print(f"解析 SRT 文件: {srt_file}")
 
-    with open(srt_file, 'r', encoding='utf-8') as f:
-        content = f.read()
+    with open(srt_file, 'rb') as f:
+        st = os.fstat(f.fileno())
+        if stat.S_ISREG(st.st_mode) and st.st_size > 0:
+            # Scan the memory-mapped bytes in a single regex pass, decoding only the matched fields
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mem:
+                subtitles = _parse_srt_bytes(mem)
+        else:
+            # Pipes such as --srt <(...) and empty files cannot be mapped
+            subtitles = _parse_srt_bytes(f.read())
 
-    # Split by double newlines to separate subtitle blocks
-    blocks = re.split(r'\n\s*\n', content.strip())
+    print(f"解析了 {len(subtitles)} 条字幕")
+    return subtitles
 
+
+def _parse_srt_bytes(data):
+    """Extract subtitle entries from raw SRT bytes, warning about blocks that do not parse"""
     subtitles = []
-    for block in blocks:
-        lines = block.strip().split('\n')
-        if len(lines) >= 3:
-            try:
-                # First line is the ID
-                subtitle_id = int(lines[0].strip())
-
-                # Second line is the timestamp
-                timestamp = lines[1].strip()
-
-                # Remaining lines are the text
-                text = ' '.join(lines[2:]).strip()
-
-                subtitles.append({
-                    'id': subtitle_id,
-                    'timestamp': timestamp,
-                    'text': text
-                })
-            except (ValueError, IndexError) as e:
-                print(f"警告: 跳过格式错误的块: {block[:50]}... 错误: {e}")
+    pos = 0
+    skipped = b''
+    for match in _SRT_RE.finditer(data):
+        gap = data[pos:match.start()]
+        pos = match.end()
+        if gap.strip():
+            skipped += gap
+            # A match that does not start its own block belongs to the malformed one
+            if not _SRT_BLOCK_END_RE.search(gap):
+                skipped += match.group(0)
                 continue
-
-    print(f"解析了 {len(subtitles)} 条字幕")
+        if skipped:
+            _warn_malformed_block(skipped)
+            skipped = b''
+        subtitles.append({
+            'id': int(match.group(1)),
+            'timestamp': match.group(2).decode('utf-8').strip(),
+            'text': match.group(3).decode('utf-8').replace('\r\n', ' ').replace('\r', ' ').replace('\n', ' ').strip()
+        })
+    skipped += data[pos:]
+    if skipped.strip():
+        _warn_malformed_block(skipped)
     return subtitles
 
 
-def find_reference_audio(reference_dir, subtitle_id, audio_prefix='segment'):
+def _warn_malformed_block(content):
+    """Report SRT content that does not form ID / timestamp / text entries, one warning per block"""
+    content = content.decode('utf-8', errors='replace').replace('\r\n', '\n').replace('\r', '\n')
+    for block in re.split(r'\n\s*\n', content.strip()):
+        print(f"警告: 跳过格式错误的块: {block[:50]}...")
+
+
+def _dir_entries(directory):
+    """Return the set of entry names in a directory, or an empty set if it does not exist"""
+    try:
+        with os.scandir(directory) as entries:
+            return {entry.name for entry in entries}
+    except FileNotFoundError:
+        return set()
+
+
+def _index_reference_dir(reference_dir, audio_prefix='segment'):
     """
-    Find the reference audio file for a given subtitle ID
-    Supports formats: segment_001.wav, segment_1.wav, etc.
+    Index reference audio files in a directory by subtitle ID
+    Supports formats: segment_001.wav, segment_1.wav, segment001.wav, etc.
+    Returns dict mapping subtitle ID to audio path
     """
-    # Try different naming patterns
-    patterns = [
-        f"{audio_prefix}_{subtitle_id:03d}.wav",  # segment_001.wav
-        f"{audio_prefix}_{subtitle_id:03d}.mp3",
-        f"{audio_prefix}_{subtitle_id}.wav",  # segment_1.wav
-        f"{audio_prefix}_{subtitle_id}.mp3",
-        f"{audio_prefix}{subtitle_id:03d}.wav",  # segment001.wav
-        f"{audio_prefix}{subtitle_id:03d}.mp3",
-        f"{audio_prefix}{subtitle_id}.wav",  # segment1.wav
-        f"{audio_prefix}{subtitle_id}.mp3",
-        f"{audio_prefix}_{subtitle_id:03d}.mp4",  # segment_001.mp4
-        f"{audio_prefix}_{subtitle_id:03d}.m4a",
+    name_re = re.compile(rf'^{re.escape(audio_prefix)}(_?)(\d+)\.(wav|mp3|mp4|m4a)$')
+
+    # Several files may map to one ID; keep the previous lookup priority
+    # (segment_001.wav, segment_001.mp3, segment_1.wav, segment_1.mp3, segment001.wav,
+    # segment001.mp3, segment1.wav, segment1.mp3, segment_001.mp4, segment_001.m4a),
+    # then any other spelling such as segment_01.wav, ties broken by file name
+    legacy_order = [
+        ('_', True, 'wav'), ('_', True, 'mp3'), ('_', False, 'wav'), ('_', False, 'mp3'),
+        ('', True, 'wav'), ('', True, 'mp3'), ('', False, 'wav'), ('', False, 'mp3'),
+        ('_', True, 'mp4'), ('_', True, 'm4a'),
     ]
+    legacy_rank = {key: i for i, key in enumerate(legacy_order)}
 
-    for pattern in patterns:
-        audio_path = os.path.join(reference_dir, pattern)
-        if os.path.exists(audio_path):
-            return audio_path
+    best = {}
+    with os.scandir(reference_dir) as entries:
+        for entry in entries:
+            match = name_re.match(entry.name)
+            if match is None or not entry.is_file():
+                continue
+            underscore, digits, ext = match.groups()
+            subtitle_id = int(digits)
+            if digits == f"{subtitle_id:03d}":
+                key = (underscore, True, ext)
+            elif digits == str(subtitle_id):
+                key = (underscore, False, ext)
+            else:
+                key = None
+            rank = (legacy_rank.get(key, len(legacy_order)), entry.name)
+            if subtitle_id not in best or rank < best[subtitle_id][0]:
+                best[subtitle_id] = (rank, entry.path)
 
-    return None
+    return {subtitle_id: path for subtitle_id, (_, path) in best.items()}
 
 
 def parse_args():
@@ -203,10 +282,17 @@ def parse_args():
         help='设备 (cuda:0, cpu 等)。如果不指定则自动检测'
     )
 
+    parser.add_argument(
+        '--cpu-threads',
+        type=int,
+        default=None,
+        help='CPU 推理使用的线程数（默认: 逻辑核心数的一半）'
+    )
+
     parser.add_argument(
         '--load-jit',
         action='store_true',
-        help='加载 JIT 模型以加速推理'
+        help='加载 JIT 模型以加速推理（同时对 HiFT 声码器进行 TorchScript 跟踪）'
     )
 
     parser.add_argument(
@@ -227,6 +313,37 @@ def parse_args():
         help='使用 FP16 精度（仅 GPU）'
     )
 
+    parser.add_argument(
+        '--debug-compile',
+        action='store_true',
+        help='[批量模式] 输出 torch.compile 重新编译日志'
+    )
+
+    parser.add_argument(
+        '--hift-cuda-graph',
+        action='store_true',
+        help='使用 CUDA Graph 回放 HiFT 声码器（仅 GPU，按长度分桶捕获）'
+    )
+
+    parser.add_argument(
+        '--int8',
+        action='store_true',
+        help='将 LLM 量化为 INT8（CPU 使用 torch 动态量化，GPU 需要 bitsandbytes；与 vLLM 不兼容）'
+    )
+
+    parser.add_argument(
+        '--compile',
+        action=argparse.BooleanOptionalAction,
+        default=None,
+        help='[批量模式] 使用 torch.compile 加速推理（仅 GPU，默认在字幕数大于 4 时开启）'
+    )
+
+    parser.add_argument(
+        '--single-gpu',
+        action='store_true',
+        help='[批量模式] 只使用一张 GPU（默认在多张 GPU 上并行处理）'
+    )
+
     parser.add_argument(
         '--skip-existing',
         action='store_true',
@@ -240,13 +357,19 @@ def parse_args():
         help='随机种子（用于可重复性）'
     )
 
+    parser.add_argument(
+        '--fast-seed',
+        action='store_true',
+        help='[批量模式] 只在开始时设置一次随机种子，不再为每条字幕单独设置（整体结果仍可复现，但单条结果依赖处理顺序）'
+    )
+
     return parser.parse_args()
 
 
-def initialize_cosyvoice(model_dir, load_jit, load_trt, load_vllm, fp16):
+def initialize_cosyvoice(model_dir, load_jit, load_trt, load_vllm, fp16, int8=False, hift_cuda_graph=False):
     """Initialize CosyVoice2 model"""
     print(f"初始化 CosyVoice2 模型: {model_dir}")
-    print(f"  JIT: {load_jit}, TRT: {load_trt}, vLLM: {load_vllm}, FP16: {fp16}")
+    print(f"  JIT: {load_jit}, TRT: {load_trt}, vLLM: {load_vllm}, FP16: {fp16}, INT8: {int8}")
     
     cosyvoice = CosyVoice2(
         model_dir,
@@ -255,31 +378,202 @@ def initialize_cosyvoice(model_dir, load_jit, load_trt, load_vllm, fp16):
         load_vllm=load_vllm,
         fp16=fp16
     )
+
+    if load_jit:
+        trace_hift(cosyvoice)
+
+    if hift_cuda_graph:
+        if torch.cuda.is_available():
+            capture_hift_graph(cosyvoice)
+        else:
+            print("  无可用 GPU，忽略 HiFT CUDA Graph")
+
+    if int8:
+        if load_vllm:
+            print("  vLLM 已接管 LLM 推理，忽略 INT8 量化")
+        else:
+            quantize_llm_int8(cosyvoice)
+
+    # Allow TF32 matmuls for the parts of the model that stay in FP32
+    torch.set_float32_matmul_precision('high')
     
     print(f"模型初始化成功，采样率: {cosyvoice.sample_rate} Hz")
     return cosyvoice
 
 
-def synthesize_with_cosyvoice(cosyvoice, text, prompt_text, prompt_audio_path,
-                               output_path, instruct_text='', seed=42):
+def initialize_cosyvoice_from_args(args):
+    """Initialize CosyVoice2 model from parsed command line arguments"""
+    return initialize_cosyvoice(
+        args.model_dir,
+        args.load_jit,
+        args.load_trt,
+        args.load_vllm,
+        args.fp16,
+        args.int8,
+        args.hift_cuda_graph
+    )
+
+
+def quantize_llm_int8(cosyvoice):
     """
-    Synthesize speech using CosyVoice2
-    
-    Args:
-        cosyvoice: CosyVoice2 model instance
-        text: Text to synthesize
-        prompt_text: Text content of the reference audio
-        prompt_audio_path: Path to reference audio file
-        output_path: Output audio file path
-        instruct_text: Natural language instruction (optional)
-        seed: Random seed
+    Quantize the CosyVoice2 LLM linear layers to INT8
+
+    On CPU the whole LLM is dynamically quantized with torch.ao. On GPU the
+    Qwen2 backbone linears are swapped for bitsandbytes Linear8bitLt layers.
+    Flow and HiFT keep their original precision.
     """
-    # Load reference audio (16kHz)
-    prompt_speech_16k = load_wav(prompt_audio_path, 16000)
-    
-    # Set random seed for reproducibility
-    set_all_random_seed(seed)
-    
+    model = cosyvoice.model
+    if model.device.type == 'cpu':
+        model.llm = torch.ao.quantization.quantize_dynamic(model.llm, {torch.nn.Linear}, dtype=torch.qint8)
+    else:
+        try:
+            import bitsandbytes as bnb
+        except ImportError:
+            print("  未安装 bitsandbytes，忽略 INT8 量化")
+            return
+
+        def replace_linear(module):
+            for name, child in module.named_children():
+                if isinstance(child, torch.nn.Linear):
+                    int8_linear = bnb.nn.Linear8bitLt(child.in_features, child.out_features,
+                                                      bias=child.bias is not None, has_fp16_weights=False)
+                    int8_linear.weight = bnb.nn.Int8Params(child.weight.data.cpu(), requires_grad=False,
+                                                           has_fp16_weights=False)
+                    if child.bias is not None:
+                        int8_linear.bias = torch.nn.Parameter(child.bias.data.cpu(), requires_grad=False)
+                    # Moving to the GPU is what actually quantizes the weights
+                    setattr(module, name, int8_linear.to(model.device))
+                else:
+                    replace_linear(child)
+
+        replace_linear(model.llm.llm)
+    print("LLM 已量化为 INT8")
+
+
+def trace_hift(cosyvoice):
+    """
+    Trace the HiFT vocoder with TorchScript
+
+    HiFT is driven through inference(), which is not traceable as a whole, so the
+    f0 predictor and decode() it calls are traced and swapped in place. Falls
+    back to eager mode if tracing fails.
+    """
+    hift = cosyvoice.model.hift
+    device = cosyvoice.model.device
+    try:
+        with torch.no_grad():
+            example_mel = torch.randn(1, hift.conv_pre.in_channels, 200, device=device)
+            f0 = hift.f0_predictor(example_mel)
+            example_source, _, _ = hift.m_source(hift.f0_upsamp(f0[:, None]).transpose(1, 2))
+            example_source = example_source.transpose(1, 2)
+            traced_decode = torch.jit.trace_module(
+                hift, {'decode': (example_mel, example_source)}, strict=False).decode
+            traced_f0_predictor = torch.jit.trace(hift.f0_predictor, example_mel, strict=False)
+    except Exception as e:
+        print(f"  ✗ HiFT TorchScript 跟踪失败，使用 eager 模式: {str(e)}")
+        return
+
+    hift.decode = traced_decode
+    hift.f0_predictor = traced_f0_predictor
+    print("HiFT 声码器已使用 TorchScript 跟踪")
+
+
+class HiftGraphRunner:
+    """
+    Replay the HiFT spectrum decoder from CUDA graphs
+
+    CUDA graphs need static shapes, so mel inputs are zero-padded to the smallest
+    bucket that fits and one graph is captured per bucket on first use. Longer
+    inputs run eagerly.
+    """
+
+    def __init__(self, decode_spec, buckets=(100, 200, 400, 800)):
+        self.decode_spec = decode_spec
+        self.buckets = sorted(buckets)
+        self.graphs = {}
+
+    def _capture(self, x, s, bucket):
+        source_len = bucket * (s.shape[2] // x.shape[2])
+        static_x = x.new_zeros(x.shape[0], x.shape[1], bucket)
+        static_s = s.new_zeros(s.shape[0], s.shape[1], source_len)
+
+        # Warm up on a side stream before capture, as required by torch.cuda.graph
+        side_stream = torch.cuda.Stream()
+        side_stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(side_stream):
+            for _ in range(3):
+                self.decode_spec(static_x, static_s)
+        torch.cuda.current_stream().wait_stream(side_stream)
+
+        graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(graph):
+            static_out = self.decode_spec(static_x, static_s)
+        return graph, static_x, static_s, static_out
+
+    def __call__(self, x, s):
+        length = x.shape[2]
+        bucket = next((b for b in self.buckets if b >= length), None)
+        if bucket is None or length == 0:
+            return self.decode_spec(x, s)
+
+        if bucket not in self.graphs:
+            self.graphs[bucket] = self._capture(x, s, bucket)
+        graph, static_x, static_s, static_out = self.graphs[bucket]
+
+        static_x.zero_()
+        static_x[:, :, :length].copy_(x)
+        static_s.zero_()
+        static_s[:, :, :s.shape[2]].copy_(s)
+        graph.replay()
+
+        # Each padded mel frame adds a fixed number of spectrum frames, trim them off
+        bucket_frames = static_out[0].shape[2]
+        frames = bucket_frames - (bucket - length) * (bucket_frames // bucket)
+        return tuple(out[:, :, :frames].clone() for out in static_out)
+
+
+def capture_hift_graph(cosyvoice):
+    """Run the HiFT spectrum decoder through bucketed CUDA graphs"""
+    hift = cosyvoice.model.hift
+    if 'decode' in vars(hift):
+        print("  HiFT decode() 已被替换（TorchScript），跳过 CUDA Graph")
+        return
+    # decode() copies the STFT window to the device on every call, which is not allowed during capture
+    hift.stft_window = hift.stft_window.to(cosyvoice.model.device)
+    hift._decode_spec = HiftGraphRunner(hift._decode_spec)
+    print("HiFT 声码器将使用 CUDA Graph 回放")
+
+
+def compile_cosyvoice(cosyvoice):
+    """
+    Compile the hot CosyVoice2 submodules with torch.compile
+
+    The model calls llm/flow/hift through their inference() methods rather than
+    forward(), so the modules actually invoked per step are compiled instead:
+    the flow decoder estimator, the HiFT decode() and the Qwen2 backbone.
+
+    The default inductor mode is used everywhere: mel lengths differ for nearly
+    every subtitle, and reduce-overhead would record a new CUDA graph per shape.
+    Use --hift-cuda-graph for bucketed CUDA graph replay of the vocoder.
+    """
+    model = cosyvoice.model
+    print("使用 torch.compile 编译模型")
+
+    # Flow matching estimator (replaced by a TensorRT wrapper with --load-trt)
+    if isinstance(model.flow.decoder.estimator, torch.nn.Module):
+        model.flow.decoder.estimator = torch.compile(model.flow.decoder.estimator, fullgraph=False)
+
+    # HiFT vocoder, unless it already runs through TorchScript or CUDA graphs
+    if 'decode' not in vars(model.hift) and '_decode_spec' not in vars(model.hift):
+        model.hift.decode = torch.compile(model.hift.decode, fullgraph=False)
+
+    # LLM backbone, unless vLLM has taken it over
+    if not hasattr(model.llm, 'vllm'):
+        model.llm.llm.model = torch.compile(model.llm.llm.model, fullgraph=False)
+
+
+def run_inference(cosyvoice, text, prompt_text, prompt_speech_16k, instruct_text=''):
+    """Run CosyVoice2 inference and return the first synthesized speech tensor"""
     # Choose inference method based on instruct_text
     if instruct_text:
         # Use instruct mode (requires CosyVoice2-Instruct model)
@@ -298,12 +592,56 @@ def synthesize_with_cosyvoice(cosyvoice, text, prompt_text, prompt_audio_path,
             prompt_speech_16k,
             stream=False
         )
+
+    return _first_speech(inference_gen)
+
+
+def _first_speech(inference_gen):
+    """Take the first synthesized speech tensor from a CosyVoice2 inference generator"""
+    # Inference generators are lazy, so the model runs inside this context. Precision
+    # is left to CosyVoice2Model: with --fp16 it autocasts the flow and keeps HiFT in FP32
+    with torch.inference_mode():
+        try:
+            result = next(inference_gen)  # Only take the first result
+        except StopIteration:
+            raise RuntimeError("模型没有生成任何音频")
+        finally:
+            # Stop the generator now instead of leaving it to the garbage collector
+            inference_gen.close()
+    return result['tts_speech']
+
+
+def save_speech(cosyvoice, tts_speech, output_path):
+    """Save synthesized speech to a 16-bit PCM WAV file"""
+    # soundfile writes the numpy view directly, skipping torchaudio's backend dispatch
+    sf.write(output_path, tts_speech.squeeze(0).numpy(), cosyvoice.sample_rate, subtype='PCM_16')
+
+
+def synthesize_with_cosyvoice(cosyvoice, text, prompt_text, prompt_audio_path,
+                               output_path, instruct_text='', seed=42,
+                               prompt_speech_16k=None):
+    """
+    Synthesize speech using CosyVoice2
     
-    # Get the synthesized audio
-    for i, result in enumerate(inference_gen):
-        tts_speech = result['tts_speech']
-        torchaudio.save(output_path, tts_speech, cosyvoice.sample_rate)
-        break  # Only take the first result
+    Args:
+        cosyvoice: CosyVoice2 model instance
+        text: Text to synthesize
+        prompt_text: Text content of the reference audio
+        prompt_audio_path: Path to reference audio file
+        output_path: Output audio file path
+        instruct_text: Natural language instruction (optional)
+        seed: Random seed
+        prompt_speech_16k: Preloaded 16kHz reference audio (optional, skips loading)
+    """
+    # Load reference audio (16kHz)
+    if prompt_speech_16k is None:
+        prompt_speech_16k = _load_prompt_cached(prompt_audio_path)
+    
+    # Set random seed for reproducibility
+    set_all_random_seed(seed)
+
+    tts_speech = run_inference(cosyvoice, text, prompt_text, prompt_speech_16k, instruct_text)
+    save_speech(cosyvoice, tts_speech, output_path)
 
 
 def process_single_mode(args, cosyvoice):
@@ -312,11 +650,7 @@ def process_single_mode(args, cosyvoice):
     print("单条模式")
     print("=" * 60)
 
-    # Validate reference audio
-    if not os.path.exists(args.reference):
-        print(f"错误: 参考音频文件不存在: {args.reference}")
-        return
-
+    # A missing reference audio is reported by load_wav below, no separate existence check
     print(f"\n文本: {args.text}")
     print(f"参考音频: {args.reference}")
     if args.prompt_text:
@@ -346,7 +680,211 @@ def process_single_mode(args, cosyvoice):
         traceback.print_exc()
 
 
-def process_batch_mode(args, cosyvoice):
+def synthesize_subtitles(args, cosyvoice, subtitles, tag=''):
+    """
+    Synthesize a list of parsed subtitles with one CosyVoice2 instance
+    Returns (success_count, skip_count, error_count)
+    """
+    total = len(subtitles)
+    success_count = 0
+    skip_count = 0
+    error_count = 0
+
+    # Determine if using single audio for all subtitles
+    use_single_audio = args.audio_path is not None
+
+    # Load the shared reference audio once for all subtitles
+    shared_prompt_speech_16k = None
+    id_to_path = {}
+    if use_single_audio:
+        try:
+            shared_prompt_speech_16k = _load_prompt_cached(args.audio_path)
+        except Exception as e:
+            print(f"错误: 无法加载参考音频 {args.audio_path}: {str(e)}")
+            return 0, 0, total
+    else:
+        # Scan the reference directory once instead of probing per subtitle
+        id_to_path = _index_reference_dir(args.reference_dir, args.audio_prefix)
+
+    # List the output directory once instead of checking each output file
+    existing_outputs = _dir_entries(args.output) if args.skip_existing else set()
+
+    # Resolve reference audio and output paths up front
+    pending = []
+    for subtitle in subtitles:
+        subtitle_id = subtitle['id']
+
+        # Find reference audio
+        if use_single_audio:
+            ref_audio = args.audio_path
+        else:
+            ref_audio = id_to_path.get(subtitle_id)
+
+        if not ref_audio:
+            print(f"  ✗ 警告: 未找到 ID {subtitle_id} 的参考音频")
+            error_count += 1
+            continue
+
+        # Generate output filename
+        output_filename = f"{args.output_prefix}_{subtitle_id:03d}.wav"
+        output_path = os.path.join(args.output, output_filename)
+
+        # Skip if exists and flag is set
+        if output_filename in existing_outputs:
+            print(f"  ⊘ 跳过: {output_filename} (已存在)")
+            skip_count += 1
+            continue
+
+        pending.append((ref_audio, subtitle, output_path))
+
+    # Compile by default only when the warmup cost can be amortized over the batch,
+    # and not at all when there is nothing left to synthesize
+    use_compile = args.compile if args.compile is not None else len(pending) > 4
+    if pending and use_compile and torch.cuda.is_available() and not args.load_trt:
+        compile_cosyvoice(cosyvoice)
+
+        # Warm up on the first pending subtitle so compilation is not charged to a real item
+        warmup_audio, warmup_subtitle, _ = pending[0]
+        print("预热编译中（首次可能需要较长时间）...")
+        try:
+            run_inference(
+                cosyvoice,
+                warmup_subtitle['text'],
+                args.prompt_text,
+                _load_prompt_cached(warmup_audio),
+                args.instruct
+            )
+        except Exception as e:
+            print(f"  ✗ 预热失败: {str(e)}")
+
+    # Group subtitles sharing a reference audio, so the prompt features are extracted
+    # once per group instead of once per subtitle
+    pending.sort(key=lambda item: item[0])
+    groups = [(ref_audio, list(group)) for ref_audio, group in groupby(pending, key=lambda item: item[0])]
+
+    # Load reference audio and write outputs on background threads so the CPU work
+    # overlaps with GPU inference instead of serializing with it
+    loader = ThreadPoolExecutor(max_workers=2)
+    writer = ThreadPoolExecutor(max_workers=4)
+    save_futures = []
+    next_prompt = None
+    if groups and not use_single_audio:
+        next_prompt = loader.submit(_load_prompt_cached, groups[0][0])
+
+    # Seed once for the whole run instead of reseeding every subtitle
+    if args.fast_seed:
+        set_all_random_seed(args.seed)
+
+    idx = 0
+    try:
+        for group_idx, (ref_audio, group) in enumerate(groups):
+            try:
+                if use_single_audio:
+                    prompt_speech_16k = shared_prompt_speech_16k
+                else:
+                    prompt_future = next_prompt
+                    # Prefetch the next reference audio while this group is synthesized
+                    if group_idx + 1 < len(groups):
+                        next_prompt = loader.submit(_load_prompt_cached, groups[group_idx + 1][0])
+                    prompt_speech_16k = prompt_future.result()
+            except Exception as e:
+                print(f"  ✗ 加载参考音频 {ref_audio} 时出错: {str(e)}")
+                idx += len(group)
+                error_count += len(group)
+                continue
+
+            processed = 0
+            batch_gen = None
+            try:
+                if args.instruct:
+                    # Instruct mode cannot reuse cached prompt features, synthesize one by one
+                    inference_gens = [None] * len(group)
+                else:
+                    inference_gens = batch_gen = cosyvoice.inference_zero_shot_batch(
+                        [subtitle['text'] for _, subtitle, _ in group],
+                        args.prompt_text,
+                        prompt_speech_16k,
+                        stream=False
+                    )
+
+                for (_, subtitle, output_path), inference_gen in zip(group, inference_gens):
+                    processed += 1
+                    idx += 1
+                    subtitle_id = subtitle['id']
+                    text = subtitle['text']
+                    output_filename = os.path.basename(output_path)
+
+                    print(f"\n{tag}[{idx}/{total}] ID: {subtitle_id}")
+                    print(f"文本: {text[:80]}{'...' if len(text) > 80 else ''}")
+
+                    try:
+                        if not args.fast_seed:
+                            set_all_random_seed(args.seed + subtitle_id)  # Different seed for each subtitle
+                        if inference_gen is None:
+                            tts_speech = run_inference(
+                                cosyvoice, text, args.prompt_text, prompt_speech_16k, args.instruct)
+                        else:
+                            tts_speech = _first_speech(inference_gen)
+
+                        # Write the file in the background while the next subtitle is synthesized.
+                        # CosyVoice2Model.tts already yields speech on the host, so no extra
+                        # device-to-host staging is needed before handing it to the writer
+                        save_future = writer.submit(save_speech, cosyvoice, tts_speech, output_path)
+                        save_futures.append((subtitle_id, output_filename, save_future))
+
+                        print(f"  ✓ 已生成: {output_filename}")
+                        success_count += 1
+
+                    except Exception as e:
+                        print(f"  ✗ 处理 ID {subtitle_id} 时出错: {str(e)}")
+                        error_count += 1
+                        continue
+
+            except Exception as e:
+                # Prompt feature extraction failed, the rest of the group cannot be synthesized
+                print(f"  ✗ 处理参考音频 {ref_audio} 时出错: {str(e)}")
+                idx += len(group) - processed
+                error_count += len(group) - processed
+            finally:
+                # zip() stops on the group and never exhausts the generator, close it so the
+                # cached prompt features are released now rather than when it is collected
+                if batch_gen is not None:
+                    batch_gen.close()
+    finally:
+        loader.shutdown(wait=True)
+        writer.shutdown(wait=True)
+
+    # Collect results of the background writes
+    for subtitle_id, output_filename, save_future in save_futures:
+        if save_future.exception() is not None:
+            print(f"  ✗ 保存 ID {subtitle_id} ({output_filename}) 时出错: {str(save_future.exception())}")
+            success_count -= 1
+            error_count += 1
+
+    return success_count, skip_count, error_count
+
+
+def _batch_worker(rank, shards, args, stats, init_lock):
+    """
+    Process one shard of subtitles on GPU `rank` (spawned by process_batch_mode)
+    The process only sees its own GPU through CUDA_VISIBLE_DEVICES, so torch,
+    ONNX Runtime and vLLM all place the model on cuda:0
+    """
+    try:
+        if args.load_trt:
+            # The first worker exports the TensorRT engine, the others wait and then load it
+            with init_lock:
+                cosyvoice = initialize_cosyvoice_from_args(args)
+        else:
+            cosyvoice = initialize_cosyvoice_from_args(args)
+        stats[rank] = synthesize_subtitles(args, cosyvoice, shards[rank], tag=f"[GPU {rank}] ")
+    except Exception as e:
+        # Count the shard as failed instead of taking the other workers down with it
+        print(f"[GPU {rank}] ✗ 处理失败: {str(e)}")
+        stats[rank] = (0, 0, len(shards[rank]))
+
+
+def process_batch_mode(args):
     """Process SRT file with reference audio directory"""
     print("\n" + "=" * 60)
     print("批量模式")
@@ -369,69 +907,47 @@ def process_batch_mode(args, cosyvoice):
         print("错误: SRT 文件中没有有效字幕")
         return
 
-    # Process statistics
     total = len(subtitles)
-    success_count = 0
-    skip_count = 0
-    error_count = 0
-
     print(f"\n处理 {total} 条字幕...")
     print("-" * 60)
 
-    # Determine if using single audio for all subtitles
-    use_single_audio = args.audio_path is not None
-
-    # Process each subtitle entry
-    for idx, subtitle in enumerate(subtitles, 1):
-        subtitle_id = subtitle['id']
-        text = subtitle['text']
-
-        print(f"\n[{idx}/{total}] ID: {subtitle_id}")
-        print(f"文本: {text[:80]}{'...' if len(text) > 80 else ''}")
-
-        # Find reference audio
-        if use_single_audio:
-            ref_audio = args.audio_path
-        else:
-            ref_audio = find_reference_audio(
-                args.reference_dir,
-                subtitle_id,
-                args.audio_prefix
-            )
-
-        if not ref_audio:
-            print(f"  ✗ 警告: 未找到 ID {subtitle_id} 的参考音频")
-            error_count += 1
-            continue
-
-        try:
-            # Generate output filename
-            output_filename = f"{args.output_prefix}_{subtitle_id:03d}.wav"
-            output_path = os.path.join(args.output, output_filename)
-
-            # Skip if exists and flag is set
-            if args.skip_existing and os.path.exists(output_path):
-                print(f"  ⊘ 跳过: {output_filename} (已存在)")
-                skip_count += 1
-                continue
-
-            synthesize_with_cosyvoice(
-                cosyvoice=cosyvoice,
-                text=text,
-                prompt_text=args.prompt_text,
-                prompt_audio_path=ref_audio,
-                output_path=output_path,
-                instruct_text=args.instruct,
-                seed=args.seed + subtitle_id  # Different seed for each subtitle
-            )
-
-            print(f"  ✓ 已保存: {output_filename}")
-            success_count += 1
-
-        except Exception as e:
-            print(f"  ✗ 处理 ID {subtitle_id} 时出错: {str(e)}")
-            error_count += 1
-            continue
+    # Subtitles are independent, so shard them round-robin across all visible GPUs
+    n_workers = min(torch.cuda.device_count(), total)
+    if n_workers > 1 and not args.single_gpu and args.device is None:
+        print(f"使用 {n_workers} 张 GPU 并行处理")
+        # Deal out length-sorted subtitles so every GPU gets a similar mix of short and long texts;
+        # outputs are named by subtitle ID, so processing order does not matter
+        by_length = sorted(subtitles, key=lambda subtitle: len(subtitle['text']))
+        shards = [by_length[rank::n_workers] for rank in range(n_workers)]
+        # Pin each worker to one GPU before it initializes CUDA; a set_device() call in the
+        # worker would not reach the ONNX Runtime frontend or vLLM, which default to device 0
+        visible = os.environ.get('CUDA_VISIBLE_DEVICES')
+        devices = visible.split(',') if visible else [str(rank) for rank in range(n_workers)]
+        ctx = mp.get_context('spawn')
+        with ctx.Manager() as manager:
+            stats = manager.dict()
+            init_lock = manager.Lock()
+            workers = []
+            try:
+                for rank in range(n_workers):
+                    # Spawned children inherit the environment as it is at start()
+                    os.environ['CUDA_VISIBLE_DEVICES'] = devices[rank].strip()
+                    worker = ctx.Process(target=_batch_worker, args=(rank, shards, args, stats, init_lock))
+                    worker.start()
+                    workers.append(worker)
+            finally:
+                if visible is None:
+                    os.environ.pop('CUDA_VISIBLE_DEVICES', None)
+                else:
+                    os.environ['CUDA_VISIBLE_DEVICES'] = visible
+            for worker in workers:
+                worker.join()
+            # A worker that died without reporting (e.g. killed on OOM) counts its whole shard as errors
+            counts = [stats.get(rank, (0, 0, len(shards[rank]))) for rank in range(n_workers)]
+            success_count, skip_count, error_count = (sum(column) for column in zip(*counts))
+    else:
+        cosyvoice = initialize_cosyvoice_from_args(args)
+        success_count, skip_count, error_count = synthesize_subtitles(args, cosyvoice, subtitles)
 
     # Print summary
     print("\n" + "=" * 60)
@@ -449,36 +965,45 @@ def main():
     """Main execution function"""
     args = parse_args()
 
+    # Persist torch.compile (Inductor) artifacts so later runs skip recompilation
+    os.environ.setdefault('TORCHINDUCTOR_CACHE_DIR', os.path.expanduser('~/.cache/cosyvoice/inductor'))
+    os.environ.setdefault('TORCHINDUCTOR_FX_GRAPH_CACHE', '1')
+    if args.debug_compile:
+        # torch is already imported, so TORCH_LOGS would be ignored; enable the logs directly
+        os.environ.setdefault('TORCH_LOGS', 'recompiles')
+        torch._logging.set_logs(recompiles=True)
+
     # Determine device
     if args.device is None:
         device = "cuda:0" if torch.cuda.is_available() else "cpu"
     else:
         device = args.device
 
+    # Avoid oversubscribing cores on CPU inference, default to half of the logical cores
+    if device == "cpu":
+        cpu_threads = args.cpu_threads or max(1, (os.cpu_count() or 2) // 2)
+        os.environ.setdefault('OMP_NUM_THREADS', str(cpu_threads))
+        torch.set_num_threads(cpu_threads)
+        torch.set_num_interop_threads(2)
+
     print("=" * 60)
     print("CosyVoice2 语音克隆脚本")
     print("=" * 60)
     print(f"设备: {device}")
+    if device == "cpu":
+        print(f"CPU 线程数: {torch.get_num_threads()}")
     print(f"输出目录: {args.output}")
     print(f"模型目录: {args.model_dir}")
 
     # Create output directory
     os.makedirs(args.output, exist_ok=True)
 
-    # Initialize CosyVoice2
-    cosyvoice = initialize_cosyvoice(
-        args.model_dir,
-        args.load_jit,
-        args.load_trt,
-        args.load_vllm,
-        args.fp16
-    )
-
-    # Process based on mode
+    # Process based on mode (batch mode initializes CosyVoice2 itself, possibly once per GPU)
     if args.text:
+        cosyvoice = initialize_cosyvoice_from_args(args)
         process_single_mode(args, cosyvoice)
     else:
-        process_batch_mode(args, cosyvoice)
+        process_batch_mode(args)
 
     print("\n" + "=" * 60)
     print("✓ 处理完成")